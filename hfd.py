@@ -5,9 +5,34 @@ import subprocess
 import argparse
 import json
 import re
+import fnmatch
+import hashlib
+import urllib.request
+import urllib.error
+import http.client
 from pathlib import Path
 import shutil
-import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+# aria2c options that do not depend on the command line
+_ARIA2C_BASE = (
+    "aria2c", "--summary-interval=1", "--file-allocation=none",
+    "--max-tries=10000000", "--retry-wait=1",
+    "--disk-cache=32M", "--async-dns=false", "--disable-ipv6=true",
+    "-k", "1M", "-c",
+)
+
+# Seconds to wait on the metadata API before falling back to the cache
+_METADATA_TIMEOUT = 30
+
+_REDIRECT_RE = re.compile(rb'redirect', re.IGNORECASE)
+_LINE_BREAK_RE = re.compile(rb'[\r\n]')
 
 # Color definitions using ANSI escape codes
 class Colors:
@@ -16,12 +41,6 @@ class Colors:
     YELLOW = '\033[1;33m'
     NC = '\033[0m'  # No Color
 
-def signal_handler(sig, frame):
-    print(f"{Colors.YELLOW}\nDownload interrupted. You can resume by re-running the command.{Colors.NC}")
-    sys.exit(1)
-
-signal.signal(signal.SIGINT, signal_handler)
-
 def display_help():
     help_text = """
 Usage:
@@ -45,6 +64,7 @@ Options:
   --local-dir     (Optional) Directory path to store the downloaded data.
   --revision      (Optional) Model/Dataset revision to download (default: main).
   --enable_mirror (Optional) Download from hf-mirror.com.
+  --metadata_ttl  (Optional) Seconds to trust cached metadata before revalidating it (default: 3600).
 Example:
   python hfd.py gpt2
   python hfd.py bigscience/bloom-560m --exclude *.safetensors --enable_mirror
@@ -79,113 +99,245 @@ def generate_command_string(args):
         f"REVISION={args.revision}"
     ])
 
+def atomic_write(path, data):
+    # Write beside the target and rename over it so an interrupt never leaves a truncated file
+    tmp = path.with_suffix(path.suffix + '.tmp')
+    with open(tmp, 'wb' if isinstance(data, bytes) else 'w') as f:
+        if isinstance(data, (str, bytes)):
+            f.write(data)
+        else:
+            f.writelines(data)
+    os.replace(tmp, path)
+
 def fetch_and_save_metadata(args, metadata_file):
+    etag_file = metadata_file.with_suffix('.etag')
     headers = {"Authorization": f"Bearer {args.hf_token}"} if args.hf_token else {}
-    cmd = ["curl", "-L", "-s", "-o", str(metadata_file), args.api_url]
-    if args.hf_token:
-        cmd.extend(["-H", f"Authorization: Bearer {args.hf_token}"])
-    
-    process = subprocess.run(cmd, capture_output=True, text=True)
-    if process.returncode != 0:
-        print(f"{Colors.RED}[Error] Failed to fetch metadata from {args.api_url}. Error: {process.stderr}{Colors.NC}")
+    if metadata_file.exists() and etag_file.exists():
+        # Revalidate the cached copy so an unchanged repo costs a 304 instead of a full download
+        headers["If-None-Match"] = etag_file.read_text().strip()
+
+    request = urllib.request.Request(args.api_url, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=_METADATA_TIMEOUT) as response:
+            body = response.read()
+            etag = response.headers.get('ETag')
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            print(f"{Colors.GREEN}Using cached metadata: {metadata_file}{Colors.NC}")
+            # Restart the TTL window now that the cache is known to be current
+            os.utime(metadata_file, None)
+            return metadata_file.read_bytes()
+        # A transient server error should not stop a resume that already has metadata
+        if metadata_file.exists() and (e.code == 429 or e.code >= 500):
+            print(f"{Colors.YELLOW}[Warning] Failed to revalidate metadata (HTTP {e.code} {e.reason}), using cached metadata: {metadata_file}{Colors.NC}")
+            return metadata_file.read_bytes()
+        print(f"{Colors.RED}[Error] Failed to fetch metadata from {args.api_url}. Error: HTTP {e.code} {e.reason}{Colors.NC}")
+        sys.exit(1)
+    except (OSError, http.client.HTTPException) as e:
+        # Covers URLError as well as resets, timeouts and truncated bodies while reading
+        reason = getattr(e, 'reason', None) or repr(e)
         if metadata_file.exists():
-            metadata_file.unlink()
+            print(f"{Colors.YELLOW}[Warning] Failed to revalidate metadata ({reason}), using cached metadata: {metadata_file}{Colors.NC}")
+            return metadata_file.read_bytes()
+        print(f"{Colors.RED}[Error] Failed to fetch metadata from {args.api_url}. Error: {reason}{Colors.NC}")
         sys.exit(1)
-    
-    with open(metadata_file, 'r') as f:
-        return f.read()
 
-def check_authentication(response, args):
-    try:
-        data = json.loads(response)
-        gated = data.get('gated', False)
-        if gated and (not args.hf_token or not args.hf_username):
-            print(f"{Colors.RED}The repository requires authentication, but --hf_username and --hf_token is not passed. "
-                  f"Please get token from https://huggingface.co/settings/tokens.\nExiting.{Colors.NC}")
-            sys.exit(1)
-    except json.JSONDecodeError:
-        if '"gated":true' in response and (not args.hf_token or not args.hf_username):
-            print(f"{Colors.RED}The repository requires authentication, but --hf_username and --hf_token is not passed. "
-                  f"Please get token from https://huggingface.co/settings/tokens.\nExiting.{Colors.NC}")
-            sys.exit(1)
+    atomic_write(metadata_file, body)
+    if etag:
+        atomic_write(etag_file, etag)
+    elif etag_file.exists():
+        etag_file.unlink()
+    return body
 
-def should_regenerate_filelist(args, local_dir):
+def check_authentication(metadata, args):
+    if metadata.get('gated', False) and (not args.hf_token or not args.hf_username):
+        print(f"{Colors.RED}The repository requires authentication, but --hf_username and --hf_token is not passed. "
+              f"Please get token from https://huggingface.co/settings/tokens.\nExiting.{Colors.NC}")
+        sys.exit(1)
+
+def should_regenerate_filelist(args, local_dir, metadata):
     command_file = local_dir / '.hfd' / 'last_download_command'
-    current_command = generate_command_string(args)
+    # Only a fixed-size digest is stored. Besides the command it covers the commit sha and the
+    # sibling names and sizes, so a new revision rebuilds the list but changing counters don't
+    digest = hashlib.blake2b(generate_command_string(args).encode(), digest_size=16)
+    digest.update(f"SHA={metadata.get('sha') or ''}".encode())
+    for sib in metadata.get('siblings', []):
+        digest.update(f"\n{sib.get('rfilename')}\t{sib.get('size')}".encode())
+    current_hash = digest.hexdigest()
     fileslist_file = local_dir / args.fileslist_file
     
-    if not fileslist_file.exists() or not command_file.exists():
-        command_file.parent.mkdir(parents=True, exist_ok=True)
-        with open(command_file, 'w') as f:
-            f.write(current_command)
-        return True
+    if fileslist_file.exists() and command_file.exists():
+        with open(command_file, 'r') as f:
+            if f.read().strip() == current_hash:
+                return False
+    
+    command_file.parent.mkdir(parents=True, exist_ok=True)
+    atomic_write(command_file, current_hash)
+    return True
+
+def _glob_to_hyperscan(pattern):
+    # Same semantics as fnmatch, but no character may match the newline separating names in the scan buffer
+    res = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            if not res or res[-1] != '.*':
+                res.append('.*')
+        elif c == '?':
+            res.append('.')
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] == '!':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j == -1:
+                res.append('\\[')
+                continue
+            stuff = pattern[i:j].replace('\\', '\\\\').replace('[', '\\[').replace(']', '\\]')
+            i = j + 1
+            if stuff.startswith('!'):
+                res.append('[^\\n' + stuff[1:] + ']')
+            elif stuff.startswith('^'):
+                res.append('[\\' + stuff + ']')
+            else:
+                res.append('[' + stuff + ']')
+        else:
+            res.append(re.escape(c))
+    return f"^(?:{''.join(res)})$".encode()
+
+def _hyperscan_match_indices(patterns, files):
+    if not files:
+        return set()
+    expressions = [_glob_to_hyperscan(p) for p in patterns]
+    db = hyperscan.Database()
+    try:
+        db.compile(expressions=expressions, ids=list(range(len(expressions))), elements=len(expressions),
+                   flags=[hyperscan.HS_FLAG_MULTILINE | hyperscan.HS_FLAG_UTF8] * len(expressions))
+    except hyperscan.error:
+        return None
+    
+    # Patterns are anchored per line, so a match's end offset identifies the file
+    encoded = [f.encode() for f in files]
+    line_ends = {}
+    offset = 0
+    for i, name in enumerate(encoded):
+        offset += len(name)
+        line_ends[offset] = i
+        offset += 1
     
-    with open(command_file, 'r') as f:
-        saved_command = f.read().strip()
+    matched = set()
+    def on_match(pattern_id, start, end, flags, context):
+        matched.add(line_ends[end])
+    db.scan(b"\n".join(encoded), match_event_handler=on_match)
+    return matched
+
+def filter_files(files, include, exclude):
+    # Match all names against all patterns in one Hyperscan pass when available
+    if hyperscan is not None:
+        files = list(files)
+        included = _hyperscan_match_indices(include, files) if include else range(len(files))
+        excluded = _hyperscan_match_indices(exclude, files) if exclude else set()
+        if included is not None and excluded is not None:
+            return (f for i, f in enumerate(files) if i in included and i not in excluded)
     
-    if current_command != saved_command:
-        with open(command_file, 'w') as f:
-            f.write(current_command)
-        return True
-    return False
+    # Translate every glob once and combine them into a single anchored matcher per side
+    include_regex = re.compile('|'.join(fnmatch.translate(p) for p in include)) if include else None
+    exclude_regex = re.compile('|'.join(fnmatch.translate(p) for p in exclude)) if exclude else None
+    return (f for f in files if (include_regex is None or include_regex.match(f)) and
+            (exclude_regex is None or not exclude_regex.match(f)))
+
+def select_files(args, metadata):
+    files = (sib['rfilename'] for sib in metadata.get('siblings', []) if sib.get('rfilename'))
+    if args.include or args.exclude:
+        files = filter_files(files, args.include, args.exclude)
+    return files
 
-def generate_file_list(args, response, local_dir):
+def write_file_list(args, files, local_dir):
     fileslist_file = local_dir / args.fileslist_file
     
-    include_regex = '|'.join(re.escape(p).replace(r'\*', '.*') for p in args.include) if args.include else ""
-    exclude_regex = '|'.join(re.escape(p).replace(r'\*', '.*') for p in args.exclude) if args.exclude else ""
+    # Loop-invariant parts of every entry are formatted once
+    url_prefix = f"{args.hf_endpoint}/{args.download_api_path}/resolve/{args.revision}/"
+    auth_line = f"  header=Authorization: Bearer {args.hf_token}\n" if args.hf_token else ""
     
-    try:
-        data = json.loads(response)
-        files = [sib['rfilename'] for sib in data.get('siblings', []) if sib.get('rfilename')]
-        
-        filtered_files = []
+    def emit():
         for file in files:
-            if (not include_regex or re.search(include_regex, file)) and \
-                (not exclude_regex or not re.search(exclude_regex, file)):
-                filtered_files.append(file)
-        
-        with open(fileslist_file, 'w') as f:
-            for file in filtered_files:
-                url = f"{args.hf_endpoint}/{args.download_api_path}/resolve/{args.revision}/{file}"
-                if args.tool == "aria2c":
-                    f.write(f"{url}\n")
-                    f.write(f"  dir={os.path.dirname(file)}\n")
-                    f.write(f"  out={os.path.basename(file)}\n")
-                    if args.hf_token:
-                        f.write(f"  header=Authorization: Bearer {args.hf_token}\n")
-                    f.write("\n")
-                else:
-                    f.write(f"{url}\n")
+            if args.tool == "aria2c":
+                # rfilename is always a POSIX path, so one rpartition yields both dir and name
+                d, _, b = file.rpartition('/')
+                yield f"{url_prefix}{file}\n  dir={d}\n  out={b}\n{auth_line}\n"
+            else:
+                yield f"{url_prefix}{file}\n"
     
-    except json.JSONDecodeError:
-        print(f"{Colors.YELLOW}[Warning] Failed to parse JSON, using basic filtering{Colors.NC}")
-        files = re.findall(r'"rfilename":"([^"]*)"', response)
-        
-        with open(fileslist_file, 'w') as f:
-            for file in files:
-                if (not include_regex or re.search(include_regex, file)) and \
-                   (not exclude_regex or not re.search(exclude_regex, file)):
-                    url = f"{args.hf_endpoint}/{args.download_api_path}/resolve/{args.revision}/{file}"
-                    if args.tool == "aria2c":
-                        f.write(f"{url}\n")
-                        f.write(f"  dir={os.path.dirname(file)}\n")
-                        f.write(f"  out={os.path.basename(file)}\n")
-                        if args.hf_token:
-                            f.write(f"  header=Authorization: Bearer {args.hf_token}\n")
-                        f.write("\n")
-                    else:
-                        f.write(f"{url}\n")
+    atomic_write(fileslist_file, emit())
 
-def verify_files(local_dir, metadata):
-    data = json.loads(metadata)
-    for sib in data.get('siblings', []):
-        file_path = local_dir / sib['rfilename']
-        expected_size = sib.get('size')
-        if expected_size and file_path.exists() and file_path.stat().st_size != expected_size:
-            print(f"{Colors.RED}File {file_path} is incomplete!{Colors.NC}")
-            return False
-    return True
+def generate_file_list(args, metadata, local_dir):
+    write_file_list(args, select_files(args, metadata), local_dir)
+
+def _collect_sizes(directory, names):
+    # One directory read per parent; only the wanted entries are stat'ed
+    sizes = {}
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name in names and entry.is_file():
+                    sizes[entry.name] = entry.stat().st_size
+    except FileNotFoundError:
+        pass
+    return sizes
+
+def verify_files(local_dir, metadata, files):
+    # Only the files selected for the file list are checked; their parent directories are scanned in parallel
+    expected = {sib['rfilename']: sib.get('size') for sib in metadata.get('siblings', []) if sib.get('rfilename')}
+    by_dir = {}
+    for name in files:
+        d, _, b = name.rpartition('/')
+        by_dir.setdefault(d, set()).add(b)
+    
+    dirs = list(by_dir)
+    with ThreadPoolExecutor() as pool:
+        results = pool.map(lambda d: _collect_sizes(local_dir / d, by_dir[d]), dirs)
+    
+    mismatched = []
+    for d, sizes in zip(dirs, results):
+        for b, actual_size in sizes.items():
+            name = f"{d}/{b}" if d else b
+            expected_size = expected.get(name)
+            if expected_size and actual_size != expected_size:
+                print(f"{Colors.RED}File {local_dir / name} is incomplete!{Colors.NC}")
+                mismatched.append(name)
+    return mismatched
+
+def _progress_lines(stream):
+    # Split on bare \r as well as \n: wget redraws its progress bar with carriage returns only
+    pending = b''
+    while True:
+        chunk = stream.read1(1 << 16)
+        if not chunk:
+            break
+        *lines, pending = _LINE_BREAK_RE.split(pending + chunk)
+        yield from (line for line in lines if line)
+    if pending:
+        yield pending
+
+def stream_output(process):
+    # Buffer every progress line but flush to the terminal at most 10 times per second
+    out = sys.stdout.buffer
+    sys.stdout.flush()
+    last = 0.0
+    for line in _progress_lines(process.stdout):
+        if _REDIRECT_RE.search(line):
+            continue
+        # Pad so a shorter line fully overwrites the previous one after the carriage return
+        out.write(b'\r' + line.strip() + b' ' * 20)
+        now = time.monotonic()
+        if now - last > 0.1:
+            out.flush()
+            last = now
+    out.flush()
 
 def main():
     parser = argparse.ArgumentParser(add_help=False)
@@ -202,6 +354,7 @@ def main():
     parser.add_argument('--revision', default='main', help='Model/Dataset revision')
     parser.add_argument('--enable_mirror', action='store_true')
     parser.add_argument('--max_retries', type=int, default=1000000)
+    parser.add_argument('--metadata_ttl', type=int, default=3600, help='Seconds before cached metadata is revalidated')
     
     args = parser.parse_args()
     
@@ -225,89 +378,103 @@ def main():
     
     if args.revision != "main":
         args.metadata_api_path = f"{args.metadata_api_path}/revision/{args.revision}"
-    args.api_url = f"{args.hf_endpoint}/api/{args.metadata_api_path}"
+    # blobs=true makes the API report each sibling's size, which verify_files checks against
+    args.api_url = f"{args.hf_endpoint}/api/{args.metadata_api_path}?blobs=true"
     args.metadata_file = args.local_dir / '.hfd' / 'repo_metadata.json'
     args.fileslist_file = Path(f".hfd/{args.tool}_urls.txt")
     
-    check_command('curl')
     check_command(args.tool)
     
     if not args.metadata_file.exists():
         print(f"{Colors.YELLOW}Fetching repo metadata...{Colors.NC}")
         response = fetch_and_save_metadata(args, args.metadata_file)
-        check_authentication(response, args)
+    elif time.time() - args.metadata_file.stat().st_mtime > args.metadata_ttl:
+        print(f"{Colors.YELLOW}Revalidating cached metadata...{Colors.NC}")
+        response = fetch_and_save_metadata(args, args.metadata_file)
     else:
         print(f"{Colors.GREEN}Using cached metadata: {args.metadata_file}{Colors.NC}")
-        with open(args.metadata_file, 'r') as f:
-            response = f.read()
-        check_authentication(response, args)
+        response = args.metadata_file.read_bytes()
+    try:
+        metadata = json.loads(response)
+    except json.JSONDecodeError:
+        print(f"{Colors.RED}[Error] Failed to parse repo metadata: {args.metadata_file}{Colors.NC}")
+        args.metadata_file.unlink()
+        sys.exit(1)
+    check_authentication(metadata, args)
     
-    if should_regenerate_filelist(args, args.local_dir):
+    if should_regenerate_filelist(args, args.local_dir, metadata):
         if args.fileslist_file.exists():
             args.fileslist_file.unlink()
         print(f"{Colors.YELLOW}Generating file list...{Colors.NC}")
-        generate_file_list(args, response, args.local_dir)
+        generate_file_list(args, metadata, args.local_dir)
     else:
         print(f"{Colors.GREEN}Resume from file list: {args.local_dir / args.fileslist_file}{Colors.NC}")
     
     print(f"{Colors.YELLOW}Starting download with {args.tool} to {args.local_dir}...{Colors.NC}")
     os.chdir(args.local_dir)
+    fileslist_str = os.fspath(args.fileslist_file)
     
     if args.tool == "aria2c":
         cmd = [
-            "aria2c", "--summary-interval=1", "--file-allocation=none", 
-            "--check-integrity=true","--max-tries=10000000","--retry-wait=1",
-            "--disk-cache=32M", "--async-dns=false", "--disable-ipv6=true",
+            *_ARIA2C_BASE,
             "-x", str(args.x), "-j", str(args.j), "-s", str(args.x),
-            "-k", "1M", "-c", "-i", args.fileslist_file, 
-            "--save-session", args.fileslist_file,
+            "-i", fileslist_str, "--save-session", fileslist_str,
         ]
     else:
         cmd = [
             "wget", "-x", "-nH", f"--cut-dirs={args.cut_dirs}",
-            "--input-file", args.fileslist_file, "--continue",
+            "--input-file", fileslist_str, "--continue",
             "--progress=bar:force", "nv",  # Changed to refresh progress
         ]
         if args.hf_token:
             cmd.append(f"--header=Authorization: Bearer {args.hf_token}")
         
-    # Use Popen instead of run to handle output in real-time
-    process = subprocess.Popen(cmd, text=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    
-    # Print progress with carriage return for refresh effect
-    for line in process.stdout:
-        if 'redirect' not in line.lower():
-            print(f"\r{line.strip()}", flush=True)
-    
-    process.wait()
-    
-    print()  # New line after download completes
-
     max_retries = args.max_retries
     attempt = 0
+    redownloaded = set()
     while attempt < max_retries:
         attempt += 1
         print(f"{Colors.YELLOW}Attempt {attempt} of {max_retries}...{Colors.NC}")
         
-        process = subprocess.Popen(cmd, text=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        
-        # Print progress
-        for line in process.stdout:
-            if 'redirect' not in line.lower():
-                print(f"\r{line.strip()}", flush=True, end="")
+        # Use Popen instead of run to handle output in real-time
+        process = subprocess.Popen(cmd, bufsize=1 << 16, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
         
-        process.wait()
+        # Print progress with carriage return for refresh effect
+        try:
+            stream_output(process)
+            process.wait()
+        except KeyboardInterrupt:
+            # The child got the same SIGINT; let it finish writing its session file before exiting
+            process.wait()
+            raise
         
         print()  # New line after download attempt
         
         if process.returncode == 0:
-            print(f"{Colors.GREEN}Download completed successfully. Repo directory: {os.getcwd()}{Colors.NC}")
-            break
+            mismatched = verify_files(Path.cwd(), metadata, select_files(args, metadata))
+            if not mismatched:
+                print(f"{Colors.GREEN}Download completed successfully. Repo directory: {os.getcwd()}{Colors.NC}")
+                break
+            if redownloaded.issuperset(mismatched):
+                print(f"{Colors.RED}[Error] Files still do not match the repo metadata after a fresh download. "
+                      f"The repo may have changed; re-run with --metadata_ttl 0 to refresh the metadata.{Colors.NC}")
+                sys.exit(1)
+            # Resuming cannot shrink or fix a file of the wrong size, so fetch these from scratch
+            for name in mismatched:
+                Path(name).unlink(missing_ok=True)
+                Path(f"{name}.aria2").unlink(missing_ok=True)
+            redownloaded.update(mismatched)
+            write_file_list(args, mismatched, Path.cwd())
+            print(f"{Colors.RED}Downloaded files do not match the sizes in the repo metadata. Re-downloading {len(mismatched)} file(s)...{Colors.NC}")
         else:
             print(f"{Colors.RED}Download failed with return code {process.returncode}. Retrying...{Colors.NC}")
-            if attempt == max_retries:
-                print(f"{Colors.RED}Max retries ({max_retries}) reached. Download failed.{Colors.NC}")
-                sys.exit(1)
+        if attempt == max_retries:
+            print(f"{Colors.RED}Max retries ({max_retries}) reached. Download failed.{Colors.NC}")
+            sys.exit(1)
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except KeyboardInterrupt:
+        print(f"{Colors.YELLOW}\nDownload interrupted. You can resume by re-running the command.{Colors.NC}")
+        sys.exit(130)